@@ -1,79 +1,82 @@
 """This script calculates cropland areas for CONUS counties.
 The cropland map is based on the LGRIP30 L3 version 2 dataset.
 """
-import geopandas as gpd
-import pandas as pd
-import rioxarray
-from cycles.gadm import read_gadm
-from shapely.geometry import Polygon
+import numpy as np
+import rasterio
+from rasterio import features, windows
+from shapely.geometry import box
+from gadm_cache import read_gadm
 from config import GADM_PATH
 from config import AREA_CSV, MIN_REPORT_AREA
-from config import LU_MAP, MANAGEMENT_TYPES
+from config import LU_MAP, LU_TYPES, AG_TYPES
+from grid_utils import calculate_row_areas
 
-CONUS_CENTRAL_LON = -98.583 # central longitude of the CONUS (degree)
-DI = DJ = 0.00026949    # LGRI30 grid size (degree)
-LAT0 = 24.0             # reference latitude (degree)
-IND_J = lambda lat: int(round((lat - LAT0) / DJ))
+TILE_SIZE = 4096
 
 
-def get_lgrip_grid(x, y):
-    x0 = max(-180, x)
-    x1 = min(180, x + DI)
-    y0 = max(-90, y)
-    y1 = min(90, y + DJ)
+def iterate_tiles(src):
+    for row_off in range(0, src.height, TILE_SIZE):
+        for col_off in range(0, src.width, TILE_SIZE):
+            yield windows.Window(
+                col_off,
+                row_off,
+                min(TILE_SIZE, src.width - col_off),
+                min(TILE_SIZE, src.height - row_off),
+            )
 
-    points = [(x0, y0), (x0, y1), (x1, y1), (x1, y0), (x0, y0)]
 
-    return Polygon([[p[0], p[1]] for p in points])
+def accumulate_tile(src, window, conus_gdf, areas):
+    """Add the cropland areas of one raster tile to the per-county accumulators.
 
+    Instead of clipping the raster once per county (which re-reads overlapping tiles for adjacent counties), every
+    tile is read once and each pixel is dispatched to its county through a rasterized county-id array.
+    """
+    arr = src.read(1, window=window)
 
-def calculate_grid_areas(latitudes, crs):
-    area_df = latitudes.to_pandas().reset_index()
-    area_df['ind'] = area_df['y'].map(lambda y: IND_J(y))
-    area_df['grid'] = area_df.apply(lambda point: get_lgrip_grid(CONUS_CENTRAL_LON, point['y']), axis=1)
-    area_gdf = gpd.GeoDataFrame(area_df, geometry='grid', crs=crs)
-    area_gdf['area_ha'] = area_gdf.to_crs('+proj=cea +units=m').area / 1.0E4
+    ag_mask = np.isin(arr, np.asarray(AG_TYPES))
+    if not ag_mask.any(): return
 
-    return area_gdf
+    # Rasterize the counties that intersect this tile onto the tile grid
+    tile_box = box(*windows.bounds(window, src.transform))
+    candidates = conus_gdf.iloc[conus_gdf.sindex.query(tile_box, predicate='intersects')]
+    if candidates.empty: return
 
+    county_arr = features.rasterize(
+        zip(candidates['geometry'], candidates['cid']),
+        out_shape=arr.shape,
+        transform=src.window_transform(window),
+        fill=-1,
+        dtype='int32',
+    )
 
-def calculate_cropland_area(lu_xds, area_gdf, boundary, gid):
-    xds = lu_xds.rio.clip([boundary], from_disk=True)
-    df = pd.DataFrame(xds[0].to_series().rename('lu'))
-    df = df[df['lu'].isin(sum(list(MANAGEMENT_TYPES.values()), []))]
-
-    # No cropland
-    if df.empty : return [0.0, 0.0]
+    # Areas of each row of LGRIP30 grid (all columns in the same row have the same area)
+    tile_rows = np.arange(window.row_off, window.row_off + arr.shape[0])
+    row_areas = calculate_row_areas(src.transform.f + src.transform.e * (tile_rows + 0.5))
 
-    # Retrieve the areas of each LGRIP30 grid
-    df = df.reset_index()
-    df['ind'] = df['y'].map(lambda y: IND_J(y))
-    df = pd.merge(df, area_gdf, on='ind', how='left')
+    for t in LU_TYPES:
+        sel = np.isin(arr, np.asarray(LU_TYPES[t])) & (county_arr >= 0)
+        if not sel.any(): continue
 
-    areas = {}
-    for t in MANAGEMENT_TYPES:
-        area = df[df['lu'].isin(MANAGEMENT_TYPES[t])]['area_ha'].sum()
-        areas[t] = area if area > MIN_REPORT_AREA else 0.0
+        rows, _ = np.nonzero(sel)
 
-    return list(areas.values())
+        # One weighted bincount accumulates every county in the tile at once
+        areas[t] += np.bincount(county_arr[sel], weights=row_areas[rows], minlength=len(areas[t]))
 
 
 def main():
-    # Read CONUS counties
+    # Read CONUS counties and tag each with an integer id for rasterization
     conus_gdf = read_gadm(GADM_PATH, 'USA', 'county', conus=True)
+    conus_gdf['cid'] = np.arange(len(conus_gdf))
 
-    # Read cropland map
-    lu_xds = rioxarray.open_rasterio(LU_MAP, masked=True)
+    # Calculate cropland areas in a single pass over the cropland map tiles
+    areas = {t: np.zeros(len(conus_gdf)) for t in LU_TYPES}
 
-    # Calculate the areas of each row of LGRIP30 grid (all columns in the same row have the same area)
-    area_gdf = calculate_grid_areas(lu_xds.coords['y'], lu_xds.rio.crs)
+    with rasterio.open(LU_MAP) as src:
+        for window in iterate_tiles(src):
+            accumulate_tile(src, window, conus_gdf, areas)
 
-    # Calculate cropland areas
-    conus_gdf[['rainfed_area', 'irrigated_area']] = conus_gdf.apply(
-        lambda x: calculate_cropland_area(lu_xds, area_gdf, x['geometry'], x.name),
-        axis=1,
-        result_type='expand',
-    )
+    for t in LU_TYPES:
+        conus_gdf[f'{t}_area'] = np.where(areas[t] > MIN_REPORT_AREA, areas[t], 0.0)
 
     conus_gdf = conus_gdf[conus_gdf['rainfed_area'] + conus_gdf['irrigated_area'] > 0.0]
     conus_gdf.rename(columns={'NAME_1': 'state', 'NAME_2': 'county'}, inplace=True)
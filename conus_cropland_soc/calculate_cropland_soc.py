@@ -2,75 +2,72 @@
 The cropland map is based on the LGRIP30 L3 version 2 dataset, and the soil organic carbon stocks are from SoilGrids250m
 version 2.0 dataset.
 """
-import geopandas as gpd
 import numpy as np
-import os
 import pandas as pd
 import rioxarray
-from shapely.geometry import Polygon
+from concurrent.futures import ProcessPoolExecutor
+from rasterio.enums import Resampling
 from config import GADM_PATH, SOILGRIDS_PATH
 from config import AREA_SOC_CSV, MIN_REPORT_AREA
 from config import LU_MAP, LU_TYPES, AG_TYPES
-from cycles.gadm import read_gadm
-from cycles.soilgrids import read_soilgrids_maps, reproject_match_soilgrids_maps
+from gadm_cache import read_gadm
+from cycles.soilgrids import SOILGRIDS_PROPERTIES, read_soilgrids_maps
+from grid_utils import calculate_grid_areas, ind_j
 
-CONUS_CENTRAL_LON = -98.583 # central longitude of the CONUS (degree)
-DI = DJ = 0.00026949    # LGRI30 grid size (degree)
-LAT0 = 24.0             # reference latitude (degree)
-IND_J = lambda lat: int(round((lat - LAT0) / DJ))
+# The raster is opened with masked=True, so SoilGrids nodata under cropland grids shows up as NaN; the NaN-skipping
+# reductions match the skipna behavior of the pandas reductions used before
 FUNCS = {
-    'mean': lambda x: x.mean(),
-    'max': lambda x: x.max(),
-    'min': lambda x: x.min(),
+    'mean': np.nanmean,
+    'max': np.nanmax,
+    'min': np.nanmin,
 }
 MAP = 'organic_carbon_stocks@0-30cm'
+SOC_MULTIPLIER = SOILGRIDS_PROPERTIES['organic_carbon_stocks']['multiplier']
+AG_ARR = np.asarray(AG_TYPES, dtype='int8')
+LU_ARRS = {t: np.asarray(LU_TYPES[t], dtype='int8') for t in LU_TYPES}
 
-def get_lgrip_grid(x, y):
-    x0 = max(-180, x)
-    x1 = min(180, x + DI)
-    y0 = max(-90, y)
-    y1 = min(90, y + DJ)
+def reduce_cropland_soc(lu, area_ha, soc):
+    """Reduction kernel for one county: cropland area and mean/max/min SOC per land use type.
 
-    points = [(x0, y0), (x0, y1), (x1, y1), (x1, y0), (x0, y0)]
+    Operates on raw numpy arrays only, so the whole classify-and-reduce step is a handful of compiled passes through
+    memory and the function can be handed county-sized arrays from any caller (serial or pooled).
+    """
+    masks = {t: np.isin(lu, LU_ARRS[t]) for t in LU_TYPES}
 
-    return Polygon([[p[0], p[1]] for p in points])
-
-
-def calculate_grid_areas(latitudes, crs):
-    area_df = latitudes.to_pandas().reset_index()
-    area_df['ind'] = area_df['y'].map(lambda y: IND_J(y))
-    area_df['grid'] = area_df.apply(lambda point: get_lgrip_grid(CONUS_CENTRAL_LON, point['y']), axis=1)
-    area_gdf = gpd.GeoDataFrame(area_df, geometry='grid', crs=crs)
-    area_gdf['area_ha'] = area_gdf.to_crs('+proj=cea +units=m').area / 1.0E4
+    result = {}
+    for t in LU_TYPES:
+        area = area_ha[masks[t]].sum()
+        result[f'{t}_area'] = area if area > MIN_REPORT_AREA else 0.0
 
-    return area_gdf
+        arr = soc[masks[t]]
+        if arr.size == 0 or result[f'{t}_area'] == 0.0 or np.isnan(arr).all():
+            result.update({f'soc_{t}_{f}': np.nan for f in FUNCS})
+            continue
 
+        result.update({f'soc_{t}_{f}': FUNCS[f](arr) for f in FUNCS})
 
-def calculate_cropland_soc(lu_xds, area_gdf, soilgrids_xds, boundary, county_id, variables):
-    with open(f'./temp/{county_id}', 'w') as f: pass
+    return result
 
-    # Align SoilGrids maps with cropland map
-    df = reproject_match_soilgrids_maps(soilgrids_xds, lu_xds, 'lu', boundary)
 
-    # No cropland
-    if df[df['lu'].isin(AG_TYPES)].empty : return [0.0, 0.0] + list(np.nan * np.ones(len(variables) - 2))
+def calculate_cropland_soc(lu_xds, soc_xds, ind_min, row_areas, boundary, variables):
+    # The two rasters are aligned on the LGRIP30 grid at state scope, so the county only needs two cheap box clips;
+    # no warping happens inside the county loop
+    lu_clip = lu_xds.rio.clip_box(*boundary.bounds).rio.clip([boundary], from_disk=False)
+    soc_clip = soc_xds.rio.clip_box(*boundary.bounds).rio.clip([boundary], from_disk=False)
 
-    # Retrieve the areas of each LGRIP30 grid
-    df = df[df['lu'].isin(AG_TYPES)].reset_index()
-    df['ind'] = df['y'].map(lambda y: IND_J(y))
-    df = pd.merge(df, area_gdf, on='ind', how='left')
+    # No cropland. The mask is computed once and reused, instead of scanning the classification twice
+    lu_arr = lu_clip[0].values
+    rows, cols = np.nonzero(np.isin(lu_arr, AG_ARR))
+    if rows.size == 0: return [0.0, 0.0] + list(np.nan * np.ones(len(variables) - 2))
 
-    result = {}
-    for t in LU_TYPES:
-        area = df[df['lu'].isin(LU_TYPES[t])]['area_ha'].sum()
-        result[f'{t}_area'] = area if area > MIN_REPORT_AREA else 0.0
+    # Downcast to float32/int8 to halve the memory bandwidth of the reductions
+    lu = lu_arr[rows, cols].astype('int8')
+    soc = soc_clip[0].values[rows, cols].astype('float32') * SOC_MULTIPLIER
 
-        sub_df = df.loc[df['lu'].isin(LU_TYPES[t])]
-        if sub_df.empty or result[f'{t}_area'] == 0.0:
-            result.update({f'soc_{t}_{f}': np.nan for f in FUNCS})
-            continue
+    # Retrieve the areas of each LGRIP30 grid with a direct array gather
+    area_ha = row_areas[ind_j(lu_clip.y.values[rows]) - ind_min]
 
-        result.update({f'soc_{t}_{f}': FUNCS[f](sub_df[MAP]) for f in FUNCS})
+    result = reduce_cropland_soc(lu, area_ha, soc)
 
     return [result[v] for v in variables]
 
@@ -90,23 +87,45 @@ def write_to_csv(conus_gdf, variables):
         f.write('#  Cropland SOC weight: Mg/ha\n')
         f.write('# NOTE\n')
         f.write('#  Cropland areas under 10 ha is reported as 0.\n')
-        conus_gdf[['NAME_1', 'NAME_2'] + variables].to_csv(
-            f,
-            float_format='%.2f',
-        )
+        # Rounding the numeric columns once beforehand lets to_csv skip the Python %-formatting of every value
+        conus_gdf[['NAME_1', 'NAME_2'] + variables].round({v: 2 for v in variables}).to_csv(f)
 
 
-def main():
-    # Read CONUS counties
-    conus_gdf = read_gadm(GADM_PATH, 'USA', 'county', conus=True)
+def process_state(state_id, sub_gdf, variables):
+    print(state_id)
 
-    # Read cropland map
-    lu_xds = rioxarray.open_rasterio(LU_MAP, masked=True)
+    # rioxarray/GDAL dataset handles are not fork-safe, so each worker opens the cropland map itself. The chunked
+    # open returns a dask-backed array so already-decoded tiles are reused between neighboring counties
+    lu_xds = rioxarray.open_rasterio(LU_MAP, masked=True, chunks={'x': 4096, 'y': 4096}, lock=False)
 
     # Calculate the areas of each LGRIP30 grid
-    area_gdf = calculate_grid_areas(lu_xds.coords['y'], lu_xds.rio.crs)
+    ind_min, row_areas = calculate_grid_areas(lu_xds.coords['y'])
+
+    # Read SoilGrids maps
+    soilgrids_xds = read_soilgrids_maps(f'{SOILGRIDS_PATH}/{state_id}', [MAP])
+
+    # Clip the cropland map to the state bounding box and warp the state SOC map onto that grid once, so the
+    # expensive reprojection is paid once per state instead of once per county
+    state_lu = lu_xds.rio.clip_box(*sub_gdf.total_bounds)
+    state_soc = soilgrids_xds[MAP].rio.reproject_match(state_lu, resampling=Resampling.nearest)
+
+    # Snap the warped coordinates onto the cropland grid; reproject_match can leave float-epsilon differences that
+    # would let the two per-county clips select off-by-one windows, and the clips are paired positionally
+    state_soc = state_soc.assign_coords({'x': state_lu.x, 'y': state_lu.y})
+
+    # A plain loop over itertuples avoids re-boxing every county row into a Series the way apply(axis=1) does
+    results = [
+        calculate_cropland_soc(state_lu, state_soc, ind_min, row_areas, row.geometry, variables)
+        for row in sub_gdf.itertuples()
+    ]
+    sub_gdf[variables] = pd.DataFrame(results, columns=variables, index=sub_gdf.index)
+
+    return sub_gdf
+
 
-    os.makedirs('temp', exist_ok=True)
+def main():
+    # Read CONUS counties
+    conus_gdf = read_gadm(GADM_PATH, 'USA', 'county', conus=True)
 
     # Generate a list of all variables that need to be calculated
     variables = [f'{t}_area' for t in LU_TYPES]
@@ -114,27 +133,16 @@ def main():
         for v in FUNCS:
             variables.append(f'soc_{t}_{v}')
 
-    # Calculate cropland areas and SOC weights
-    output_df = pd.DataFrame()
-
-    for state_id in [f'USA.{s}_1' for s in range(52)]:
-        if state_id not in conus_gdf['GID_1'].unique(): continue
-
-        sub_gdf = conus_gdf[conus_gdf['GID_1'] == state_id].copy()
-
-        # Read SoilGrids maps
-        soilgrids_xds = read_soilgrids_maps(f'{SOILGRIDS_PATH}/{state_id}', [MAP])
-
-        sub_gdf[variables] = sub_gdf.apply(
-            lambda x: calculate_cropland_soc(lu_xds, area_gdf, soilgrids_xds, x['geometry'], x['GID'], variables),
-            axis=1,
-            result_type='expand',
-        )
+    state_ids = [f'USA.{s}_1' for s in range(52) if f'USA.{s}_1' in conus_gdf['GID_1'].unique()]
 
-        output_df = pd.concat(
-            [output_df, sub_gdf],
-            axis=0,
-        )
+    # Calculate cropland areas and SOC weights. States are independent of each other, so they are processed in
+    # parallel
+    with ProcessPoolExecutor() as executor:
+        futures = [
+            executor.submit(process_state, state_id, conus_gdf[conus_gdf['GID_1'] == state_id].copy(), variables)
+            for state_id in state_ids
+        ]
+        output_df = pd.concat([future.result() for future in futures], axis=0)
 
     write_to_csv(output_df, variables)
 
@@ -1,3 +1,4 @@
+AREA_CSV = f'./conus_cropland_areas.csv'
 AREA_SOC_CSV = f'./conus_cropland_soc_0-30cm_soilgrids.csv'
 MIN_REPORT_AREA = 10.0  # minimum area to report (ha)
 
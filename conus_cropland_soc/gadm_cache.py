@@ -0,0 +1,23 @@
+"""GeoParquet-backed cache for GADM administrative boundaries.
+
+Parsing the national GADM shapefile dominates the startup of every script in this pipeline. The first read of each
+(country, level) pair is persisted as GeoParquet next to the shapefiles, so later runs load the columnar cache
+instead of re-parsing the shapefile feature by feature.
+"""
+import geopandas as gpd
+import os
+from cycles.gadm import STATE_ABBREVIATIONS                 # noqa: F401  re-exported for the scripts
+from cycles.gadm import read_gadm as _read_gadm
+
+
+def read_gadm(path, country, level, conus=False):
+    """Read a GADM layer through a GeoParquet cache, falling back to cycles.gadm.read_gadm on a cache miss."""
+    cache = os.path.join(path, f'{country}_{level}{"_conus" if conus else ""}.parquet')
+
+    if os.path.exists(cache):
+        return gpd.read_parquet(cache)
+
+    gdf = _read_gadm(path, country, level, conus=conus)
+    gdf.to_parquet(cache)
+
+    return gdf
@@ -8,25 +8,36 @@ For both type (gSSURGO and SoilGrids) soil files, hte hydrologic soil groups, sl
 using gSSURGO data.
 """
 import geopandas as gpd
+import numpy as np
 import os
 import pandas as pd
 import rioxarray
-from shapely.geometry import Point
+import xarray as xr
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from rasterio.enums import Resampling
+from scipy.spatial import cKDTree
 from config import WGS84, AEAC
 from config import AREA_SOC_CSV
 from config import LU_MAP, LU_TYPES
 from config import GADM_PATH, SOILGRIDS_PATH, GSSURGO_PATH
 from cycles.soil import SOIL_LAYERS
 from cycles.soilgrids import SOILGRIDS_PROPERTIES, SOILGRIDS_LAYERS
-from cycles.soilgrids import read_soilgrids_maps, reproject_match_soilgrids_maps
+from cycles.soilgrids import read_soilgrids_maps
 from cycles.gssurgo import GSSURGO_NON_SOIL_TYPES, GSSURGO_URBAN_TYPES
-from cycles.gssurgo import NAD83
 from cycles.gssurgo import read_state_gssurgo, get_soil_profile_parameters
-from cycles.gadm import STATE_ABBREVIATIONS
-from cycles.gadm import read_gadm
+from gadm_cache import STATE_ABBREVIATIONS
+from gadm_cache import read_gadm
 from cycles.soil import generate_soil_file
 
 
+# SoilGrids column names of each property, ordered by layer. Formatting them once here saves re-building the same
+# f-strings for every county, property, and layer
+SG_COLS = {
+    v: [f'{v}@{int(layer["top"] * 100)}-{int(layer["bottom"] * 100)}cm' for layer in SOILGRIDS_LAYERS.values()]
+    for v in ['clay', 'sand', 'soc', 'bulk_density']
+}
+
+
 def generate_description(source, county, state, irrigation_type, hsg, muname='', mukey=None, lat=None, lon=None):
     strs = f"# Cycles soil file for {irrigation_type} cropland in {county}, {state}\n#\n"
     strs += f"# Clay, sand, soil organic carbon, and bulk density are obtained from {source}.\n"
@@ -57,6 +68,179 @@ def filter_non_soil(df):
     return df
 
 
+def match_soilgrids_to_lu(soilgrids_stack, conus_lu, boundary):
+    """Align all SoilGrids layers with the cropland map for one county.
+
+    Warping the stacked multi-band array pays the transform setup once for all property/layer combinations, instead
+    of one reproject_match call per combination.
+    """
+    ref = conus_lu.rio.clip_box(*boundary.bounds).rio.clip([boundary], from_disk=True)
+    warped = soilgrids_stack.rio.reproject_match(ref, resampling=Resampling.nearest)
+    # Snap the warped coordinates onto the reference coordinates so the band series align exactly
+    warped = warped.assign_coords({'x': ref.x, 'y': ref.y})
+
+    # Build the (y, x) MultiIndex once and wrap the raveled arrays directly; to_series() pivots every band through a
+    # full intermediate DataFrame
+    index = pd.MultiIndex.from_product([ref.y.values, ref.x.values], names=['y', 'x'])
+
+    # Collect the band series in a list and concatenate once; growing the frame column by column re-copies it on
+    # every insert
+    pieces = [pd.Series(ref.values[0].ravel(), index=index, name='lu')]
+    for name in soilgrids_stack.band.values:
+        multiplier = SOILGRIDS_PROPERTIES[name.split('@')[0]]['multiplier']
+        pieces.append(pd.Series(warped.sel(band=name).values.ravel() * multiplier, index=index, name=name))
+
+    return pd.concat(pieces, axis=1, copy=False)
+
+
+# Per-state data shared by every county task, loaded once per worker process by the pool initializer so it is not
+# re-pickled for every county
+_STATE = {}
+
+
+def init_state_worker(state_soil, gssurgo_luts, state_id, maps):
+    _STATE['state_soil'] = state_soil
+    _STATE['gssurgo_luts'] = gssurgo_luts
+    _STATE['maps'] = maps
+
+    # Build the spatial index on the state soil map once per worker so county queries do not rebuild it
+    state_soil.sindex
+
+    # Raster handles are not fork-safe, so each worker opens the rasters itself
+    soilgrids_xds = read_soilgrids_maps(f'{SOILGRIDS_PATH}/{state_id}', maps)
+    _STATE['soilgrids_stack'] = xr.concat([soilgrids_xds[name] for name in maps], dim='band').assign_coords(band=maps)
+    _STATE['conus_lu'] = rioxarray.open_rasterio(LU_MAP, masked=True)
+
+    # Joined per-county frames are cached here so a rerun skips the reproject and spatial join
+    _STATE['cache_path'] = f'cache/{state_id}'
+    os.makedirs(_STATE['cache_path'], exist_ok=True)
+
+    # Soil files are written from a small thread pool so the next county's compute overlaps with the file I/O. Every
+    # file name is unique, and the pool's threads are joined when the worker process exits
+    _STATE['io_pool'] = ThreadPoolExecutor(max_workers=4)
+
+
+def process_county(index, county):
+    state_soil = _STATE['state_soil']
+    gssurgo_luts = _STATE['gssurgo_luts']
+    maps = _STATE['maps']
+    soilgrids_stack = _STATE['soilgrids_stack']
+    conus_lu = _STATE['conus_lu']
+    io_pool = _STATE['io_pool']
+    cache_path = _STATE['cache_path']
+
+    # Get county boundary and centroid
+    boundary = gpd.GeoSeries(county['geometry'], crs=WGS84)
+    centroid = boundary.to_crs('+proj=cea').centroid.to_crs(WGS84)
+
+    # Project to USA Contiguous Albers Equal Area Conic once; re-projecting inside the irrigation type loop rebuilt
+    # the transformer per type and fed an already-projected centroid back through to_crs
+    centroid_aeac = centroid.to_crs(AEAC)
+
+    # The SoilGrids maps are aligned lazily so a county whose types are all cached skips the warp entirely
+    county_df = None
+
+    # Futures of the submitted soil file writes, collected at the end so write failures surface
+    write_futures = []
+
+    for t in LU_TYPES:
+        if county[f'{t}_area'] <= 0.0: continue
+
+        # The joined frame is cached as GeoParquet, so after a crash the rerun only redoes the cheap reductions and
+        # file writes instead of the reproject and spatial join
+        cache_fn = f'{cache_path}/{index}_{t}.parquet'
+        if os.path.exists(cache_fn):
+            df = gpd.read_parquet(cache_fn)
+        else:
+            if county_df is None:
+                county_df = match_soilgrids_to_lu(soilgrids_stack, conus_lu, county['geometry'])
+
+            # Filter data by cropland type
+            sub_df = county_df[county_df['lu'].isin(LU_TYPES[t])].copy()
+
+            if sub_df.empty: continue
+
+            # Create a GeoDataFrame for spatial data processing. points_from_xy builds all points in one vectorized
+            # GEOS call instead of allocating one Python Point per grid
+            sub_df = gpd.GeoDataFrame(
+                sub_df,
+                geometry=gpd.points_from_xy(sub_df.index.get_level_values('x'), sub_df.index.get_level_values('y')),
+                crs=WGS84,
+            )
+
+            # Find the soil type of each cropland grid by querying the state-level spatial index directly, which
+            # skips the DataFrame machinery of a full sjoin. The grids are already limited to the county boundary by
+            # the cropland clip, so clipping the state soil map to the county first only re-did work the index query
+            # does anyway. Grids that fall in no soil polygon carried NaN attributes through the left join before and
+            # were dropped by filter_non_soil, so dropping them here is equivalent
+            pt_idx, poly_idx = state_soil.sindex.query(sub_df.geometry.values, predicate='within')
+            df = sub_df.iloc[pt_idx].copy()
+            soil_attributes = state_soil.iloc[poly_idx].drop(columns='geometry')
+            df[soil_attributes.columns] = soil_attributes.to_numpy()
+
+            # Remove grids that are not categorized as soil
+            df = filter_non_soil(df)
+
+            df.to_parquet(cache_fn, compression='zstd')
+
+        if df.empty: continue
+
+        # Get the average slope, the dominant hydrologic soil group, and the dominant soil type in a single pass over
+        # the frame. The hydrologic soil group column can be all-NaN, in which case its mode is empty
+        stats = df.agg({
+            'slopegradwta': 'mean',
+            'hydgrpdcd': lambda s: next(iter(s.mode()), ''),
+            'muname': lambda s: s.mode().iat[0],
+        })
+        slope, hsg, muname = stats['slopegradwta'], stats['hydgrpdcd'], stats['muname']
+
+        # Take the representative map unit from the county's own grids; several map units can share a name, so the
+        # state map may list the name first under a mukey that does not occur in this county
+        mukey = df.loc[df['muname'] == muname, 'mukey'].mode().iat[0]
+
+        # Get soil parameters of the dominant soil type
+        soil_df = get_soil_profile_parameters(gssurgo_luts, mukey)
+
+        # Calculate soil depth
+        layer_depths = [layer['bottom'] for layer in SOIL_LAYERS]
+        soil_depth = min(layer_depths, key=lambda x: abs(x - soil_df.iloc[-1]['bottom']))
+
+        # Generate a soil file using gSSURGO data
+        fn = f'./soil/{index}_{t}_gSSURGO.soil'
+        desc = generate_description('gSSURGO', county['NAME_2'], county['NAME_1'], t, hsg, muname=muname, mukey=mukey)
+        write_futures.append(io_pool.submit(generate_soil_file, fn, desc, hsg, slope, soil_depth, soil_df))
+
+        # Use the dominant soil type and drop grids with missing SoilGrids data. One NumPy reduction over the
+        # SoilGrids block replaces the per-column NaN scan of dropna
+        mask = (df['muname'] == muname).to_numpy() & ~np.isnan(df[maps].to_numpy()).any(axis=1)
+        df = df.iloc[mask]
+
+        if df.empty: continue
+
+        # Project to USA Contiguous Albers Equal Area Conic for the calculation of distances
+        df_projected = df.to_crs(AEAC)
+
+        # Find the grid with the dominant soil type closest to the county centroid. Querying a KD-tree on the raw
+        # coordinate arrays skips the per-geometry GEOS distance dispatch
+        coords = np.column_stack([df_projected.geometry.x, df_projected.geometry.y])
+        _, nearest = cKDTree(coords).query([centroid_aeac.iloc[0].x, centroid_aeac.iloc[0].y])
+        selected_point = df.iloc[nearest]
+
+        # Generate a soil file using SoilGrids parameters
+        fn = f'soil/{index}_{t}_SoilGrids.soil'
+        soilgrids_df = pd.DataFrame.from_dict(
+            {v: [SOILGRIDS_LAYERS[layer][v] for layer in SOILGRIDS_LAYERS] for v in SOILGRIDS_LAYERS[list(SOILGRIDS_LAYERS.keys())[0]]}
+        )
+
+        for v in ['clay', 'sand', 'soc', 'bulk_density']:
+            soilgrids_df[v] = selected_point[SG_COLS[v]].to_numpy()
+
+        desc = generate_description('SoilGrids', county['NAME_2'], county['NAME_1'], t, hsg, lat=selected_point['y'], lon=selected_point['x'])
+        write_futures.append(io_pool.submit(generate_soil_file, fn, desc, hsg, slope, soil_depth, soilgrids_df))
+
+    for future in write_futures: future.result()
+
+
 def main():
     # Read county boundaries
     conus_gdf = read_gadm(GADM_PATH, 'USA', 'county', conus=True)
@@ -72,9 +256,6 @@ def main():
         how='inner',
     )
 
-    # Read cropland land use map
-    conus_lu = rioxarray.open_rasterio(LU_MAP, masked=True)
-
     os.makedirs('soil', exist_ok=True)
 
     maps = []
@@ -86,92 +267,25 @@ def main():
 
         state_abbreviation = STATE_ABBREVIATIONS[state_id]
 
-        # Read state SoilGrids data
-        soilgrids_xds = read_soilgrids_maps(f'{SOILGRIDS_PATH}/{state_id}', maps)
-
         # Read gSSURGO data
         state_soil, gssurgo_luts = read_state_gssurgo(GSSURGO_PATH, state_abbreviation, group=True)
 
-        for index, county in conus_gdf[conus_gdf['GID_1'] == state_id].iterrows():
-            # Get county boundary and centroid
-            boundary = gpd.GeoSeries(county['geometry'], crs=WGS84)
-            centroid = boundary.to_crs('+proj=cea').centroid.to_crs(WGS84)
-
-            # Get county gSSURGO map
-            # Note that CRS of gSSURGO is NAD83 (EPSG:5070). Due to the size of The gSSURGO dataset, converting the CRS
-            # of the state gSSURGO database is much less computationally efficient than converting the CRS of state
-            # boundary. Therefore, use converted state boundary to crop the state gSSURGO map and then convert to WGS84.
-            soil = gpd.clip(state_soil, boundary.to_crs(NAD83), keep_geom_type=False).to_crs(WGS84)
-
-            county_df = reproject_match_soilgrids_maps(soilgrids_xds, conus_lu, 'lu', county['geometry'])
-
-            for t in LU_TYPES:
-                if county[f'{t}_area'] <= 0.0: continue
-
-                # Filter data by cropland type
-                sub_df = county_df[county_df['lu'].isin(LU_TYPES[t])].copy()
-
-                if sub_df.empty: continue
-
-                # Create a GeoDataFrame for spatial data processing
-                sub_df['coord'] = [Point(c[1], c[0]) for c in list(sub_df.index)]
-                sub_df = gpd.GeoDataFrame(sub_df, geometry='coord', crs=WGS84)
-
-                # Find the soil types of each cropland grid by joining the cropland GeoDataFrame with gSSURGO
-                # GeoDataFrame
-                df = gpd.tools.sjoin(sub_df, soil, predicate='within', how='left')
-
-                # Remove grids that are not categorized as soil
-                df = filter_non_soil(df)
-                if df.empty: continue
-
-                # Get the average slope and dominant hydrologic soil group
-                slope = df['slopegradwta'].mean()
-                try:
-                    hsg = df['hydgrpdcd'].mode()[0]
-                except:
-                    hsg = ''
-
-                # Find the dominant soil type
-                muname = df['muname'].mode()[0]
-                selected_soil = soil[soil['muname'] == muname].iloc[0]
-
-                # Get soil parameters of the dominant soil type
-                soil_df = get_soil_profile_parameters(gssurgo_luts, selected_soil.mukey)
-
-                # Calculate soil depth
-                layer_depths = [layer['bottom'] for layer in SOIL_LAYERS]
-                soil_depth = min(layer_depths, key=lambda x: abs(x - soil_df.iloc[-1]['bottom']))
-
-                # Generate a soil file using gSSURGO data
-                fn = f'./soil/{index}_{t}_gSSURGO.soil'
-                desc = generate_description('gSSURGO', county['NAME_2'], county['NAME_1'], t, hsg, muname=muname, mukey=selected_soil.mukey)
-                generate_soil_file(fn, desc, hsg, slope, soil_depth, soil_df)
-
-                # Use the dominant soil type and drop grids with missing SoilGrids data
-                df = df[df['muname'] == muname].dropna(subset=[name for name in soilgrids_xds])
-
-                if df.empty: continue
-
-                # Project to USA Contiguous Albers Equal Area Conic for the calculation of distances
-                df_projected = df.to_crs(AEAC)
-                centroid = centroid.to_crs(AEAC)
-
-                # Find the grids with the dominant soil type and closest to the county centroid
-                df['distance_to_centroid'] = df_projected.geometry.distance(centroid.iloc[0])
-                selected_point = df.loc[df['distance_to_centroid'].idxmin()]
-
-                # Generate a soil file using SoilGrids parameters
-                fn = f'soil/{index}_{t}_SoilGrids.soil'
-                soilgrids_df = pd.DataFrame.from_dict(
-                    {v: [SOILGRIDS_LAYERS[layer][v] for layer in SOILGRIDS_LAYERS] for v in SOILGRIDS_LAYERS[list(SOILGRIDS_LAYERS.keys())[0]]}
-                )
-
-                for v in ['clay', 'sand', 'soc', 'bulk_density']:
-                    soilgrids_df[v] = soilgrids_df.apply(lambda x: selected_point[f'{v}@{int(x["top"] * 100)}-{int(x["bottom"] * 100)}cm'], axis=1)
-
-                desc = generate_description('SoilGrids', county['NAME_2'], county['NAME_1'], t, hsg, lat=selected_point['y'], lon=selected_point['x'])
-                generate_soil_file(fn, desc, hsg, slope, soil_depth, soilgrids_df)
+        # Note that CRS of gSSURGO is NAD83 (EPSG:5070). Reproject the state map to WGS84 once here; reprojecting the
+        # clipped subsets inside the county loop paid the PROJ overhead for the overlapping polygons of neighboring
+        # counties over and over
+        state_soil = state_soil.to_crs(WGS84)
+
+        # Counties are independent of each other and share only the read-only per-state data, so they are dispatched
+        # to a pool of worker processes
+        with ProcessPoolExecutor(
+            initializer=init_state_worker,
+            initargs=(state_soil, gssurgo_luts, state_id, maps),
+        ) as executor:
+            futures = [
+                executor.submit(process_county, index, county)
+                for index, county in conus_gdf[conus_gdf['GID_1'] == state_id].iterrows()
+            ]
+            for future in futures: future.result()
 
 
 if __name__ == '__main__':
@@ -1,16 +1,19 @@
 """Get SoilGrids data for each CONUS state
 """
 import os
+from concurrent.futures import ThreadPoolExecutor
 from itertools import product
-from cycles.gadm import read_gadm
+from gadm_cache import read_gadm
 from cycles.soilgrids import SOILGRIDS_PROPERTIES, SOILGRIDS_LAYERS
 from cycles.soilgrids import download_soilgrids_data
 from config import GADM_PATH, SOILGRIDS_PATH
 from config import WGS84
 
+MAX_DOWNLOAD_WORKERS = 16
+
 """Get SoilGrids data given state boundary
 """
-def get_soilgrids_data(path, gid, boundary, maps):
+def get_soilgrids_data(path, gid, boundary, maps, executor):
     os.makedirs(f'{path}/{gid}', exist_ok=True)
 
     bbox = boundary.bounds
@@ -26,12 +29,12 @@ def get_soilgrids_data(path, gid, boundary, maps):
         bbox[3] + buffer[1],
     ]
 
-    download_soilgrids_data(
-        maps,
-        f'{path}/{gid}',
-        bbox,
-        WGS84,
-    )
+    # Each map is a blocking WCS request, so the downloads are submitted to the caller's thread pool and run
+    # concurrently instead of waiting out each round trip in turn
+    return [
+        executor.submit(download_soilgrids_data, [m], f'{path}/{gid}', bbox, WGS84)
+        for m in maps
+    ]
 
 
 def main():
@@ -43,9 +46,14 @@ def main():
     for v in SOILGRIDS_PROPERTIES:
         maps = maps + [f'{v}@{layer}' for layer in SOILGRIDS_PROPERTIES[v]['layers']]
 
-    # Get SoilGrids data
-    for index, row in conus_gdf.iterrows():
-        get_soilgrids_data(SOILGRIDS_PATH, row['GID'], row['geometry'], maps)
+    # Get SoilGrids data. All (state, map) downloads share one bounded pool, so states no longer wait for each other
+    # while the pool still caps the number of concurrent requests to the ISRIC server
+    with ThreadPoolExecutor(max_workers=MAX_DOWNLOAD_WORKERS) as executor:
+        futures = []
+        for index, row in conus_gdf.iterrows():
+            futures += get_soilgrids_data(SOILGRIDS_PATH, row['GID'], row['geometry'], maps, executor)
+
+        for future in futures: future.result()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,42 @@
+"""Shared LGRIP30 grid helpers for the CONUS cropland scripts.
+"""
+import numpy as np
+
+DI = DJ = 0.00026949    # LGRIP30 grid size (degree)
+LAT0 = 24.0             # reference latitude (degree)
+R = 6371007.181         # authalic Earth radius (m)
+
+def ind_j(latitudes):
+    """Row indices of the LGRIP30 grid for the given latitudes, computed in one vectorized pass.
+    """
+    return np.rint((np.asarray(latitudes) - LAT0) / DJ).astype(np.int32)
+
+
+def calculate_row_areas(latitudes):
+    """Calculate the area (ha) of one LGRIP30 grid in each given latitude row with the closed-form spherical formula
+    area = R^2 * dlon * (sin(lat1) - sin(lat0)), so no grid polygons need to be built or reprojected to an equal-area
+    CRS.
+    """
+    lats = np.asarray(latitudes)
+
+    y0 = np.deg2rad(np.maximum(lats, -90.0))
+    y1 = np.deg2rad(np.minimum(lats + DJ, 90.0))
+
+    return R * R * np.deg2rad(DI) * (np.sin(y1) - np.sin(y0)) / 1.0E4
+
+
+def calculate_grid_areas(latitudes):
+    """Calculate the areas of each row of LGRIP30 grid as a dense lookup array.
+
+    Returns (ind_min, areas) where areas[i] is the area (ha) of the grid row with index ind_min + i, so per-county
+    lookups are plain array gathers instead of index alignments.
+    """
+    lats = np.asarray(latitudes)
+
+    ind = ind_j(lats)
+    ind_min = int(ind.min())
+
+    areas = np.zeros(int(ind.max()) - ind_min + 1)
+    areas[ind - ind_min] = calculate_row_areas(lats)
+
+    return ind_min, areas
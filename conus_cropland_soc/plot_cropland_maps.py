@@ -1,15 +1,41 @@
 import geopandas as gpd
-import matplotlib.pyplot as plt
+import matplotlib
 import os
 import rioxarray
+
+# The plots are written to files only, so use the headless Agg backend; it must be chosen before pyplot is imported
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
 from matplotlib.colors import ListedColormap
+from rioxarray.exceptions import NoDataInBounds
+from shapely.geometry import box
+from config import GADM_PATH
 from config import LU_MAP
 from config import WGS84
-from gadm import STATE_ABBREVIATIONS
-from gadm import read_gadm
+from gadm_cache import STATE_ABBREVIATIONS
+from gadm_cache import read_gadm
+
+
+# Raster handle shared by the county tasks of one worker process. rasterio dataset handles are not fork-safe and do
+# not pickle, so each worker opens the cropland map itself in the pool initializer
+_WORKER = {}
+
 
+def init_plot_worker():
+    _WORKER['lu_xds'] = rioxarray.open_rasterio(LU_MAP, masked=True, chunks={'x': 1024, 'y': 1024})
+    _WORKER['raster_box'] = box(*_WORKER['lu_xds'].rio.bounds())
+
+    # One figure is reused for every county of the worker, which skips the per-county figure construction
+    _WORKER['fig'], _WORKER['ax'] = plt.subplots()
+
+
+def plot_cropland_area(county_boundary, gid, county, state, state_abbreviation):
+    lu_xds = _WORKER['lu_xds']
+
+    # Skip counties outside the raster before doing any clip work
+    if not county_boundary.intersects(_WORKER['raster_box']): return
 
-def plot_cropland_area(lu_xds, county_boundary, gid, county, state, state_abbreviation):
     colors = [
         'blue',
         'silver',
@@ -20,10 +46,13 @@ def plot_cropland_area(lu_xds, county_boundary, gid, county, state, state_abbrev
 
     gdf = gpd.GeoDataFrame({'id': [1], 'geometry': [county_boundary]}, crs=WGS84)
 
-    lu_xds = lu_xds.rio.clip([county_boundary], from_disk=True)
+    fig, ax = _WORKER['fig'], _WORKER['ax']
 
     try:
-        fig, ax = plt.subplots()
+        # Pull only the county's window from the raster before the polygon clip; clipping the full CONUS array made
+        # from_disk a no-op and paid the clip cost on the whole map for every county
+        lu_xds = lu_xds.rio.clip_box(*county_boundary.bounds).rio.clip([county_boundary], from_disk=True)
+
         img = lu_xds.plot(ax=ax, vmin=-0.5, vmax=3.5, cmap=cmap)
         cb = img.colorbar
         cb.set_ticks([0, 1, 2, 3])
@@ -33,25 +62,35 @@ def plot_cropland_area(lu_xds, county_boundary, gid, county, state, state_abbrev
         ax.set_title(f'{county}, {state}')
         ax.set_xlabel('Longitude (degree)')
         ax.set_ylabel('Latitude (degree)')
-        plt.tight_layout()
+        fig.tight_layout()
         fig.savefig(f'img/{gid}_{county.replace(" ", "")}_{state_abbreviation}.png', dpi=300)
-        plt.close()
-    except: pass
+    except (NoDataInBounds, ValueError):
+        # The clip can still come up empty when a county only touches the raster edge; anything else should surface
+        # instead of being swallowed
+        pass
+    finally:
+        # Strip this county's artists (including the colorbar axes) so they do not leak into the next plot
+        for a in fig.axes:
+            if a is not ax: a.remove()
+        ax.clear()
 
 
 def main():
     # Read CONUS counties
-    conus_gdf = read_gadm('USA', 'county', conus=True)
-
-    # Read cropland map
-    lu_xds = rioxarray.open_rasterio(LU_MAP, masked=True)
+    conus_gdf = read_gadm(GADM_PATH, 'USA', 'county', conus=True)
 
     os.makedirs('img', exist_ok=True)
 
-    conus_gdf.apply(
-        lambda x: plot_cropland_area(lu_xds, x['geometry'], x['GID'], x['NAME_2'], x['NAME_1'], STATE_ABBREVIATIONS[x['GID_1']]),
-        axis=1,
-    )
+    # Counties render independently and matplotlib state is not thread-safe, so the plots are dispatched to a pool of
+    # worker processes
+    with ProcessPoolExecutor(initializer=init_plot_worker) as executor:
+        futures = [
+            executor.submit(
+                plot_cropland_area, row.geometry, row.GID, row.NAME_2, row.NAME_1, STATE_ABBREVIATIONS[row.GID_1],
+            )
+            for row in conus_gdf.itertuples()
+        ]
+        for future in futures: future.result()
 
 
 if __name__ == '__main__':